@@ -1,18 +1,32 @@
 from __future__ import annotations
 
-from typing import Tuple, Dict, List
+from typing import Tuple, Dict, List, Optional
 from torch.multiprocessing import spawn
 
+import torch
 import networkx as nx
 from torch_geometric.data import Data, Batch
+from torch_geometric.transforms import BaseTransform
 from torch_geometric.utils.convert import to_networkx
 
 
-def floyd_warshall_source_to_all(G, source, cutoff=None):
+def edge_ids(data: Data, node_shift: int = 0, edge_shift: int = 0) -> Dict[Tuple[int, int], int]:
+    """
+    :param data: input graph
+    :param node_shift: offset added to the node indexes
+    :param edge_shift: offset added to the edge indexes
+    :return: Dict, index of every (source node, destination node) edge, by its column in edge_index
+    """
+    return {(u + node_shift, v + node_shift): i + edge_shift for i, (u, v) in enumerate(data.edge_index.t().tolist())}
+
+
+def floyd_warshall_source_to_all(G, source, cutoff=None, edges=None):
     if source not in G:
         raise nx.NodeNotFound("Source {} not in G".format(source))
 
-    edges = {edge: i for i, edge in enumerate(G.edges())}
+    # networkx orders edges by source node, which is not the edge_index order unless edge_index is sorted
+    if edges is None:
+        edges = {edge: i for i, edge in enumerate(G.edges())}
 
     level = 0  # the current level
     nextlevel = {source: 1}  # list of nodes to check at next level
@@ -37,8 +51,8 @@ def floyd_warshall_source_to_all(G, source, cutoff=None):
     return node_paths, edge_paths
 
 
-def all_pairs_shortest_path(G) -> Tuple[Dict[int, List[int]], Dict[int, List[int]]]:
-    paths = {n: floyd_warshall_source_to_all(G, n) for n in G}
+def all_pairs_shortest_path(G, edges=None) -> Tuple[Dict[int, List[int]], Dict[int, List[int]]]:
+    paths = {n: floyd_warshall_source_to_all(G, n, edges=edges) for n in G}
     node_paths = {n: paths[n][0] for n in paths}
     edge_paths = {n: paths[n][1] for n in paths}
     return node_paths, edge_paths
@@ -46,20 +60,26 @@ def all_pairs_shortest_path(G) -> Tuple[Dict[int, List[int]], Dict[int, List[int
 
 def shortest_path_distance(data: Data) -> Tuple[Dict[int, List[int]], Dict[int, List[int]]]:
     G = to_networkx(data)
-    node_paths, edge_paths = all_pairs_shortest_path(G)
+    node_paths, edge_paths = all_pairs_shortest_path(G, edges=edge_ids(data))
     return node_paths, edge_paths
 
 
 def batched_shortest_path_distance(data) -> Tuple[Dict[int, List[int]], Dict[int, List[int]]]:
-    graphs = [to_networkx(sub_data) for sub_data in data.to_data_list()]
+    data_list = data.to_data_list()
+    graphs = [to_networkx(sub_data) for sub_data in data_list]
     relabeled_graphs = []
+    relabeled_edges = []
     shift = 0
+    edge_shift = 0
     for i in range(len(graphs)):
         num_nodes = graphs[i].number_of_nodes()
         relabeled_graphs.append(nx.relabel_nodes(graphs[i], {i: i + shift for i in range(num_nodes)}))
+        # edge indexes of the batch, i.e. shifted by the edges of the preceding graphs
+        relabeled_edges.append(edge_ids(data_list[i], node_shift=shift, edge_shift=edge_shift))
         shift += num_nodes
+        edge_shift += data_list[i].num_edges
 
-    paths = [all_pairs_shortest_path(G) for G in relabeled_graphs]
+    paths = [all_pairs_shortest_path(G, edges=edges) for G, edges in zip(relabeled_graphs, relabeled_edges)]
     node_paths = {}
     edge_paths = {}
 
@@ -69,4 +89,112 @@ def batched_shortest_path_distance(data) -> Tuple[Dict[int, List[int]], Dict[int
         for k, v in path[1].items():
             edge_paths[k] = v
 
-    return node_paths, edge_paths
\ No newline at end of file
+    return node_paths, edge_paths
+
+
+def flatten_edge_paths(edge_paths, max_path_distance: int, pad_index: int,
+                       device=None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Flattens nested edge paths into padded index tensors.
+
+    :param edge_paths: pairwise node paths in edge indexes
+    :param max_path_distance: max pairwise distance between two nodes, longer paths are truncated
+    :param pad_index: edge index used to pad paths shorter than max_path_distance
+    :param device: device of the returned tensors
+    :return: source node indexes [P], destination node indexes [P], padded path edges [P, max_path_distance]
+             and path lengths [P]
+    """
+    src_idx, dst_idx, path_edges, path_len = [], [], [], []
+    for src, destinations in edge_paths.items():
+        for dst, path in destinations.items():
+            path = path[:max_path_distance]
+            src_idx.append(src)
+            dst_idx.append(dst)
+            path_edges.append(path + [pad_index] * (max_path_distance - len(path)))
+            path_len.append(len(path))
+
+    return (torch.tensor(src_idx, dtype=torch.long, device=device),
+            torch.tensor(dst_idx, dtype=torch.long, device=device),
+            torch.tensor(path_edges, dtype=torch.long, device=device).reshape(-1, max_path_distance),
+            torch.tensor(path_len, dtype=torch.long, device=device))
+
+
+def dense_batch_layout(batch: torch.Tensor, ptr: torch.Tensor,
+                       max_graph_size: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor,
+                                                                       torch.Tensor]:
+    """
+    Layout of a batch of graphs padded to its largest graph. It only depends on the batch, so it is computed once
+    per forward and the layers do not need to read sizes back from the device.
+
+    :param batch: graph index of every node
+    :param ptr: batch pointer that shows graph indexes in batch of graphs
+    :param max_graph_size: number of nodes of the largest graph, read from ptr if None
+    :return: graph index of every node [N], node index of every padded slot [B, max_graph_size] (padded slots
+             repeat an existing node), padding mask of the slots [B, max_graph_size] and index of every node into
+             the flattened slots [N]
+    """
+    num_nodes = batch.shape[0]
+    graph_sizes = ptr[1:] - ptr[:-1]
+    if max_graph_size is None:
+        max_graph_size = int(graph_sizes.max())
+
+    positions = torch.arange(max_graph_size, device=ptr.device)
+    node_index = (ptr[:-1].unsqueeze(1) + positions).clamp_(max=num_nodes - 1)
+    padding_mask = positions >= graph_sizes.unsqueeze(1)
+    flat_index = batch * max_graph_size + torch.arange(num_nodes, device=batch.device) - ptr[batch]
+
+    return batch, node_index, padding_mask, flat_index
+
+
+def single_graph_layout(num_nodes: int, device=None) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor,
+                                                                torch.Tensor]:
+    """
+    Layout of a single graph as a batch of one, see dense_batch_layout.
+
+    :param num_nodes: number of nodes of the graph
+    :param device: device of the layout tensors
+    :return: same as dense_batch_layout
+    """
+    return dense_batch_layout(torch.zeros(num_nodes, dtype=torch.long, device=device),
+                              torch.tensor([0, num_nodes], device=device),
+                              max_graph_size=num_nodes)
+
+
+class PathData(Data):
+    """
+    Data with flattened shortest edge paths (see PathIndexTransform), so that path edge indexes are shifted by the
+    number of edges of the preceding graphs when batching.
+    """
+    def __inc__(self, key, value, *args, **kwargs):
+        if key == 'path_edges':
+            return self.num_edges
+        return super().__inc__(key, value, *args, **kwargs)
+
+
+class PathIndexTransform(BaseTransform):
+    def __init__(self, max_path_distance: int):
+        """
+        Precomputes shortest edge paths of a graph once, as tensors the EdgeEncoding consumes directly.
+
+        :param max_path_distance: max pairwise distance between two nodes
+        """
+        self.max_path_distance = max_path_distance
+
+    def forward(self, data: Data) -> PathData:
+        """
+        :param data: input graph
+        :return: PathData, graph with path_src_index, path_dst_index, path_edges and path_len attributes
+        """
+        _, edge_paths = shortest_path_distance(data)
+        path_src_index, path_dst_index, path_edges, path_len = flatten_edge_paths(
+            edge_paths, self.max_path_distance, pad_index=data.num_edges, device=data.edge_index.device)
+
+        data = PathData(**{key: value for key, value in data})
+        data.path_src_index = path_src_index
+        data.path_dst_index = path_dst_index
+        data.path_edges = path_edges
+        data.path_len = path_len
+        return data
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(max_path_distance={self.max_path_distance})'
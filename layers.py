@@ -1,12 +1,26 @@
-from typing import Tuple
-from datetime import datetime
+from typing import Optional
 import torch
 from torch import nn
-from torch_geometric.utils import degree
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
-def decrease_to_max_value(x, max_value):
-    x[x > max_value] = max_value
-    return x
+from CS224W_final_project_testing.functional import single_graph_layout
+
+# allow TF32 tensor cores for the float32 matmuls that run outside of autocast
+torch.set_float32_matmul_precision('high')
+
+# SDPA kernels used by the attention. They support an additive mask and its gradient, while flash attention
+# kernels are not relied on to return a gradient for attn_mask (tests/test_model.py checks it against a reference)
+MASK_GRAD_SDPA_BACKENDS = [SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+
+
+def bf16_autocast(device: torch.device) -> torch.autocast:
+    """
+    :param device: device the computation runs on
+    :return: torch.autocast, bfloat16 autocast on GPUs with native bfloat16 support (compute capability >= 8),
+             disabled otherwise
+    """
+    enabled = device.type == 'cuda' and torch.cuda.get_device_capability(device)[0] >= 8
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled)
 
 class CentralityEncoding(nn.Module):
     def __init__(self, max_in_degree: int, max_out_degree: int, node_dim: int):
@@ -19,8 +33,8 @@ class CentralityEncoding(nn.Module):
         self.max_in_degree = max_in_degree
         self.max_out_degree = max_out_degree
         self.node_dim = node_dim
-        self.z_in = nn.Parameter(torch.randn((max_in_degree, node_dim)))
-        self.z_out = nn.Parameter(torch.randn((max_out_degree, node_dim)))
+        # in degree embeddings in the first max_in_degree rows, followed by the out degree embeddings
+        self.z = nn.Parameter(torch.randn((max_in_degree + max_out_degree, node_dim)))
 
     def forward(self, x: torch.Tensor, edge_index: torch.LongTensor) -> torch.Tensor:
         """
@@ -30,14 +44,33 @@ class CentralityEncoding(nn.Module):
         """
         num_nodes = x.shape[0]
 
-        in_degree = decrease_to_max_value(degree(index=edge_index[1], num_nodes=num_nodes).long(),
-                                          self.max_in_degree - 1)
-        out_degree = decrease_to_max_value(degree(index=edge_index[0], num_nodes=num_nodes).long(),
-                                           self.max_out_degree - 1)
+        # fixed length counts, unlike bincount whose output length depends on the largest index
+        ones = torch.ones_like(edge_index[0])
+        in_degree = torch.zeros(num_nodes, dtype=torch.long, device=x.device).scatter_add_(0, edge_index[1], ones)
+        out_degree = torch.zeros(num_nodes, dtype=torch.long, device=x.device).scatter_add_(0, edge_index[0], ones)
+        in_degree.clamp_(max=self.max_in_degree - 1)
+        out_degree.clamp_(max=self.max_out_degree - 1)
+
+        # both lookups in a single gather, without modifying x in place
+        return x + self.z[torch.stack((in_degree, out_degree + self.max_in_degree))].sum(dim=0)
+
+
+@torch.jit.script
+def gaussian_basis_mean(x: torch.Tensor, means: torch.Tensor, stds: torch.Tensor) -> torch.Tensor:
+    """
+    :param x: input matrix
+    :param means: means of the GBF heads
+    :param stds: standard deviations of the GBF heads
+    :return: torch.Tensor, mean of the GBF heads applied elementwise to x
+    """
+    # accumulate the GBF heads one at a time instead of materializing a num_heads x N x N tensor
+    inv_two_var = (2 * stds ** 2).reciprocal()
+    gbf = torch.zeros_like(x)
+    for h in range(means.shape[0]):
+        gbf += torch.exp(-(x - means[h]) ** 2 * inv_two_var[h])
+    return gbf / means.shape[0]
 
-        x += self.z_in[in_degree] + self.z_out[out_degree]
 
-        return x
 # this spatial encoding with gaussians is Dynaformer-specific, and differs from Graphormer    
 class SpatialEncoding(nn.Module):  
     def __init__(self, num_heads: int, embedding_size: int):
@@ -51,7 +84,10 @@ class SpatialEncoding(nn.Module):
         
         self.means = nn.Parameter(torch.randn(self.num_heads))
         self.stds = nn.Parameter(torch.randn(self.num_heads))
-        self.weights_dist = nn.Parameter(torch.randn(2 * self.embedding_size + 1))
+        # weights of the linear projection of [x_i, d_ij, x_j], kept as separate slices
+        self.w_left = nn.Parameter(torch.randn(self.embedding_size))
+        self.w_dist = nn.Parameter(torch.randn(1))
+        self.w_right = nn.Parameter(torch.randn(self.embedding_size))
 
     def forward(self, x: torch.Tensor, coords: torch.Tensor) -> torch.Tensor:
         """
@@ -62,17 +98,13 @@ class SpatialEncoding(nn.Module):
         # NOTE: currently averaging each GBF head (mean pooling), but is there better approach?
                 (I couln't figure out what the dynaformer paper did)
         """
-        norms = (torch.linalg.vector_norm(coords, ord=2, dim=1) ** 2).reshape(-1,1)
-        distances = torch.sqrt(norms - 2 * coords @ coords.T + norms.T)
+        distances = torch.cdist(coords, coords, p=2)
         
-        x1 = x.unsqueeze(1)
-        x0 = x.unsqueeze(0)
-        N, D = x.shape
-        concats = torch.cat((x1.expand(N, N, D), distances.unsqueeze(-1), x0.expand(N, N, D)), dim=-1)
-        concats = concats.reshape(N ** 2, 2 * D + 1) @ self.weights_dist
-        spatial_matrix = concats.reshape(N, N)
-        spatial_matrix = torch.exp((spatial_matrix - self.means.reshape(-1, 1, 1)) ** 2 / (2 * self.stds.reshape(-1,1,1) ** 2))
-        spatial_matrix = torch.mean(spatial_matrix, dim=0)  # mean pooling
+        # [x_i, d_ij, x_j] @ w == x_i @ w_left + d_ij * w_dist + x_j @ w_right, without the N x N x (2D + 1) concat
+        left = x @ self.w_left
+        right = x @ self.w_right
+        spatial_matrix = left.unsqueeze(1) + self.w_dist * distances + right.unsqueeze(0)
+        spatial_matrix = gaussian_basis_mean(spatial_matrix, self.means, self.stds)  # mean pooling
 
         return spatial_matrix
 
@@ -86,126 +118,53 @@ class EdgeEncoding(nn.Module):
         self.max_path_distance = max_path_distance
         self.edge_weights = nn.Parameter(torch.randn(self.max_path_distance, self.edge_dim))
 
-    def forward(self, x: torch.Tensor, edge_attr: torch.Tensor, edge_paths) -> torch.Tensor:
+    def forward(self, edge_attr: torch.Tensor, edge_paths) -> torch.Tensor:
         """
-        :param x: node feature matrix
         :param edge_attr: edge feature matrix
-        :param edge_paths: pairwise node paths in edge indexes
-        :return: torch.Tensor, Edge Encoding matrix
-        """
-        current_datetime = datetime.now()
-        print(current_datetime.strftime("%Y-%m-%d %H:%M:%S"))
-        
-        # Preallocate output tensor
-        device = next(self.parameters()).device
-        cij = torch.zeros((x.shape[0], x.shape[0]),device=device)
-        
-#        weights_inds = torch.arange(0, self.max_path_distance)
-#        # TODO: make this more efficient
-#        for src in edge_paths:
-#            for dst in edge_paths[src]:
-#                path_ij = edge_paths[src][dst][:self.max_path_distance]
-#                cij[src][dst] = (self.edge_weights[weights_inds[:len(path_ij)]] * edge_attr[path_ij]).sum(dim=1).mean()
-
-        # Vectorize path processing
-        for src, destinations in edge_paths.items():
-            for dst, path in destinations.items():
-                # Limit path length
-                path = path[:self.max_path_distance]
-            
-                # Use tensor operations instead of explicit loops
-                path_weights = self.edge_weights[:len(path)]
-                path_edge_features = edge_attr[path]
-            
-                # Compute path encoding, commenting out mean() for slight performance gain
-                path_encoding = (path_weights * path_edge_features).sum(dim=1) #.mean()
-                cij[src][dst] = path_encoding
-
-        current_datetime = datetime.now()
-        print(current_datetime.strftime("%Y-%m-%d %H:%M:%S"))
-        return torch.nan_to_num(cij)
-
-class GraphormerAttentionHead(nn.Module):
-    def __init__(self, dim_in: int, dim_q: int, dim_k: int, edge_dim: int, max_path_distance: int):
+        :param edge_paths: flattened pairwise node paths in edge indexes (source nodes, destination nodes,
+                           padded path edges, path lengths), see functional.flatten_edge_paths
+        :return: torch.Tensor, Edge Encoding of every (source node, destination node) pair of edge_paths
         """
-        :param dim_in: node feature matrix input number of dimension
-        :param dim_q: query node feature matrix input number dimension
-        :param dim_k: key node feature matrix input number of dimension
-        :param edge_dim: edge feature matrix number of dimension
-        """
-        super().__init__()
-        self.edge_encoding = EdgeEncoding(edge_dim, max_path_distance)
+        device = edge_attr.device
+        _, _, path_edges, path_len = edge_paths
+        path_edges = path_edges[:, :self.max_path_distance]
+        path_length = path_edges.shape[1]
 
-        self.q = nn.Linear(dim_in, dim_q)
-        self.k = nn.Linear(dim_in, dim_k)
-        self.v = nn.Linear(dim_in, dim_k)
+        # score every edge against every path position once, [E, max_path_distance], and gather the scores of
+        # the path edges, [P, max_path_distance], instead of gathering [P, max_path_distance, edge_dim] features
+        edge_scores = edge_attr @ self.edge_weights[:path_length].T
 
-    def forward(self,
-                x: torch.Tensor,
-                edge_attr: torch.Tensor,
-                b: torch.Tensor,
-                edge_paths,
-                ptr=None) -> torch.Tensor:
-        """
-        :param query: node feature matrix
-        :param key: node feature matrix
-        :param value: node feature matrix
-        :param edge_attr: edge feature matrix
-        :param b: spatial Encoding matrix
-        :param edge_paths: pairwise node paths in edge indexes
-        :param ptr: batch pointer that shows graph indexes in batch of graphs
-        :return: torch.Tensor, node embeddings after attention operation
-        """
-        batch_mask_neg_inf = torch.full(size=(x.shape[0], x.shape[0]), fill_value=-1e6).to(
-            next(self.parameters()).device)
-        batch_mask_zeros = torch.zeros(size=(x.shape[0], x.shape[0])).to(next(self.parameters()).device)
-
-        # OPTIMIZE: get rid of slices: rewrite to torch
-        if type(ptr) == type(None):
-            batch_mask_neg_inf = torch.ones(size=(x.shape[0], x.shape[0])).to(next(self.parameters()).device)
-            batch_mask_zeros += 1
-        else:
-            for i in range(len(ptr) - 1):
-                batch_mask_neg_inf[ptr[i]:ptr[i + 1], ptr[i]:ptr[i + 1]] = 1
-                batch_mask_zeros[ptr[i]:ptr[i + 1], ptr[i]:ptr[i + 1]] = 1
-
-        query = self.q(x)
-        key = self.k(x)
-        value = self.v(x)
-
-        c = self.edge_encoding(x, edge_attr, edge_paths)
-        a = self.compute_a(key, query, ptr)
-        a = (a + b + c) * batch_mask_neg_inf
-        softmax = torch.softmax(a, dim=-1) * batch_mask_zeros
-        x = softmax.mm(value)
-        return x
-
-    def compute_a(self, key, query, ptr=None):
-        if type(ptr) == type(None):
-            a = query.mm(key.transpose(0, 1)) / query.size(-1) ** 0.5
-        else:
-            a = torch.zeros((query.shape[0], query.shape[0]), device=key.device)
-            for i in range(len(ptr) - 1):
-                a[ptr[i]:ptr[i + 1], ptr[i]:ptr[i + 1]] = query[ptr[i]:ptr[i + 1]].mm(
-                    key[ptr[i]:ptr[i + 1]].transpose(0, 1)) / query.size(-1) ** 0.5
-
-        return a
+        # padded path positions may point to edges of the next graph in a batch (or past the last edge),
+        # so append a zero row for the latter and mask them out by path length
+        edge_scores = torch.cat((edge_scores, edge_scores.new_zeros((1, path_length))), dim=0)
+        positions = torch.arange(path_length, device=device)
+        path_mask = positions < path_len.unsqueeze(-1)
 
+        return (edge_scores[path_edges, positions] * path_mask).sum(dim=-1)
 
 # FIX: PyG attention instead of regular attention, due to specificity of GNNs
 class GraphormerMultiHeadAttention(nn.Module):
-    def __init__(self, num_heads: int, dim_in: int, dim_q: int, dim_k: int, edge_dim: int, max_path_distance: int):
+    def __init__(self, num_heads: int, dim_in: int, dim_q: int, dim_k: int, edge_dim: int, max_path_distance: int,
+                 edge_encoding: Optional[EdgeEncoding] = None):
         """
         :param num_heads: number of attention heads
         :param dim_in: node feature matrix input number of dimension
-        :param dim_q: query node feature matrix input number dimension
+        :param dim_q: query node feature matrix input number dimension (has to be equal to dim_k)
         :param dim_k: key node feature matrix input number of dimension
         :param edge_dim: edge feature matrix number of dimension
+        :param edge_encoding: edge encoding shared with other layers, a new one is created if None
         """
         super().__init__()
-        self.heads = nn.ModuleList(
-            [GraphormerAttentionHead(dim_in, dim_q, dim_k, edge_dim, max_path_distance) for _ in range(num_heads)]
-        )
+        self.num_heads = num_heads
+        self.dim_k = dim_k
+
+        # edge encoding does not depend on the head, so it is computed once and shared by all heads
+        if edge_encoding is None:
+            edge_encoding = EdgeEncoding(edge_dim, max_path_distance)
+        self.edge_encoding = edge_encoding
+
+        # query, key and value projections of all heads in a single matmul
+        self.qkv = nn.Linear(dim_in, 3 * num_heads * dim_k)
         self.linear = nn.Linear(num_heads * dim_k, dim_in)
 
     def forward(self,
@@ -213,28 +172,57 @@ class GraphormerMultiHeadAttention(nn.Module):
                 edge_attr: torch.Tensor,
                 b: torch.Tensor,
                 edge_paths,
-                ptr) -> torch.Tensor:
+                batch_layout,
+                c: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         :param x: node feature matrix
         :param edge_attr: edge feature matrix
         :param b: spatial Encoding matrix
-        :param edge_paths: pairwise node paths in edge indexes
-        :param ptr: batch pointer that shows graph indexes in batch of graphs
+        :param edge_paths: flattened pairwise node paths in edge indexes, see functional.flatten_edge_paths
+        :param batch_layout: layout of the batch padded to its largest graph, see functional.dense_batch_layout
+        :param c: precomputed Edge Encoding of the node pairs in edge_paths, computed by self.edge_encoding if None
         :return: torch.Tensor, node embeddings after all attention heads
         """
-        return self.linear(
-            torch.cat([
-                attention_head(x, edge_attr, b, edge_paths, ptr) for attention_head in self.heads
-            ], dim=-1)
-        )
+        # graphs of the batch are padded to the largest one, so all per-graph attention blocks run as one
+        # batched kernel instead of one N x N attention over the whole batch
+        graph_ids, node_index, padding_mask, flat_index = batch_layout
+        num_graphs, max_graph_size = node_index.shape
+
+        # [B, max_graph_size, 3 * num_heads * dim_k] -> [3, B, num_heads, max_graph_size, dim_k]
+        qkv = self.qkv(x)[node_index].reshape(num_graphs, max_graph_size, 3, self.num_heads, self.dim_k)
+        qkv = qkv.permute(2, 0, 3, 1, 4)
+        query, key, value = qkv[0], qkv[1], qkv[2]
+
+        # per-graph blocks of b, with padded keys masked out
+        attn_bias = b[node_index.unsqueeze(2), node_index.unsqueeze(1)]
+        attn_bias.masked_fill_(padding_mask.unsqueeze(1), float("-inf"))
+
+        # add the edge encoding of every node pair straight onto its bias entry instead of through an N x N matrix
+        src_idx, dst_idx = edge_paths[0], edge_paths[1]
+        node_position = flat_index - graph_ids * max_graph_size
+        if c is None:
+            c = self.edge_encoding(edge_attr, edge_paths)
+        attn_bias.index_put_((graph_ids[src_idx], node_position[src_idx], node_position[dst_idx]),
+                             c.to(attn_bias.dtype), accumulate=True)
+
+        # softmax(query @ key^T / sqrt(dim_k) + attn_bias) @ value in one fused kernel, bias is broadcast over heads.
+        # The spatial and edge encodings are only trained through attn_bias, see MASK_GRAD_SDPA_BACKENDS
+        with sdpa_kernel(MASK_GRAD_SDPA_BACKENDS):
+            x = nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=attn_bias.unsqueeze(1))
+
+        # [B, num_heads, max_graph_size, dim_k] -> [N, num_heads * dim_k], dropping the padded nodes
+        x = x.permute(0, 2, 1, 3).reshape(num_graphs * max_graph_size, self.num_heads * self.dim_k)[flat_index]
+        return self.linear(x)
 
 
 class GraphormerEncoderLayer(nn.Module):
-    def __init__(self, node_dim, edge_dim, n_heads, ff_dim, max_path_distance):
+    def __init__(self, node_dim, edge_dim, n_heads, ff_dim, max_path_distance,
+                 edge_encoding: Optional[EdgeEncoding] = None):
         """
         :param node_dim: node feature matrix input number of dimension
         :param edge_dim: edge feature matrix input number of dimension
         :param n_heads: number of attention heads
+        :param edge_encoding: edge encoding shared with other layers, a new one is created if None
         """
         super().__init__()
 
@@ -250,6 +238,7 @@ class GraphormerEncoderLayer(nn.Module):
             num_heads=n_heads,
             edge_dim=edge_dim,
             max_path_distance=max_path_distance,
+            edge_encoding=edge_encoding,
         )
         self.ln_1 = nn.LayerNorm(self.node_dim)
         self.ln_2 = nn.LayerNorm(self.node_dim)
@@ -265,7 +254,8 @@ class GraphormerEncoderLayer(nn.Module):
                 edge_attr: torch.Tensor,
                 b: torch,
                 edge_paths,
-                ptr) -> Tuple[torch.Tensor, torch.Tensor]:
+                batch_layout=None,
+                c: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         h′(l) = MHA(LN(h(l−1))) + h(l−1)
         h(l) = FFN(LN(h′(l))) + h′(l)
@@ -273,11 +263,18 @@ class GraphormerEncoderLayer(nn.Module):
         :param x: node feature matrix
         :param edge_attr: edge feature matrix
         :param b: spatial Encoding matrix
-        :param edge_paths: pairwise node paths in edge indexes
-        :param ptr: batch pointer that shows graph indexes in batch of graphs
+        :param edge_paths: flattened pairwise node paths in edge indexes, see functional.flatten_edge_paths
+        :param batch_layout: layout of the batch padded to its largest graph, see functional.dense_batch_layout,
+                             None for a single graph
+        :param c: precomputed Edge Encoding of the node pairs in edge_paths, computed by the layer if None
         :return: torch.Tensor, node embeddings after Graphormer layer operations
         """
-        x_prime = self.attention(self.ln_1(x), edge_attr, b, edge_paths, ptr) + x
-        x_new = self.ff(self.ln_2(x_prime)) + x_prime
+        if batch_layout is None:
+            batch_layout = single_graph_layout(x.shape[0], device=x.device)
+
+        # matmuls and attention run in bfloat16, layer norms and the float32 residual stream stay in float32
+        with bf16_autocast(x.device):
+            x_prime = self.attention(self.ln_1(x), edge_attr, b, edge_paths, batch_layout, c) + x
+            x_new = self.ff(self.ln_2(x_prime)) + x_prime
 
         return x_new
@@ -2,10 +2,12 @@ from typing import Union
 
 import torch
 from torch import nn
-from torch_geometric.data import Data
+from torch_geometric.data import Data, Batch
 
-from CS224W_final_project_testing.functional import shortest_path_distance, batched_shortest_path_distance
-from CS224W_final_project_testing.layers import GraphormerEncoderLayer, CentralityEncoding, SpatialEncoding
+from CS224W_final_project_testing.functional import shortest_path_distance, batched_shortest_path_distance, \
+    flatten_edge_paths, dense_batch_layout, single_graph_layout
+from CS224W_final_project_testing.layers import GraphormerEncoderLayer, CentralityEncoding, SpatialEncoding, \
+    EdgeEncoding
 
 
 class Graphormer(nn.Module):
@@ -21,7 +23,9 @@ class Graphormer(nn.Module):
                  max_in_degree: int,
                  max_out_degree: int,
                  max_path_distance: int,
-                 num_heads_spatial: int):
+                 num_heads_spatial: int,
+                 share_edge_encoding: bool = False,
+                 compile_layers: bool = False):
         """
         :param num_layers: number of Graphormer layers
         :param input_node_dim: input dimension of node features
@@ -33,6 +37,11 @@ class Graphormer(nn.Module):
         :param max_in_degree: max in degree of nodes
         :param max_out_degree: max in degree of nodes
         :param max_path_distance: max pairwise distance between two nodes
+        :param num_heads_spatial: number of encoding heads in the GBF function
+        :param share_edge_encoding: share one edge encoding across all layers, so it is computed once per forward
+        :param compile_layers: compile every Graphormer layer with torch.compile (changes state_dict keys to
+                               layers.N._orig_mod.*). Opt-in and off by default until tests/test_model.py has
+                               confirmed on a real torch install that the layers trace without graph breaks
         """
         super().__init__()
 
@@ -48,6 +57,8 @@ class Graphormer(nn.Module):
         self.max_out_degree = max_out_degree
         self.max_path_distance = max_path_distance
         self.num_heads_spatial = num_heads_spatial
+        self.share_edge_encoding = share_edge_encoding
+        self.compile_layers = compile_layers
 
         self.node_in_lin = nn.Linear(self.input_node_dim, self.node_dim)
         self.edge_in_lin = nn.Linear(self.input_edge_dim, self.edge_dim)
@@ -63,18 +74,28 @@ class Graphormer(nn.Module):
             embedding_size=self.node_dim
         )
 
-        self.layers = nn.ModuleList([
+        if self.share_edge_encoding:
+            self.edge_encoding = EdgeEncoding(edge_dim=self.edge_dim, max_path_distance=self.max_path_distance)
+        else:
+            self.edge_encoding = None
+
+        layers = [
             GraphormerEncoderLayer(
                 node_dim=self.node_dim,
                 edge_dim=self.edge_dim,
                 n_heads=self.n_heads,
                 ff_dim=self.ff_dim,
-                max_path_distance=self.max_path_distance) for _ in range(self.num_layers)
-        ])
+                max_path_distance=self.max_path_distance,
+                edge_encoding=self.edge_encoding) for _ in range(self.num_layers)
+        ]
+        if self.compile_layers:
+            # node, edge and path counts change with every graph, so compile for dynamic shapes
+            layers = [torch.compile(layer, dynamic=True) for layer in layers]
+        self.layers = nn.ModuleList(layers)
 
         self.node_out_lin = nn.Linear(self.node_dim, self.output_dim)
 
-    def forward(self, data: Union[Data]) -> torch.Tensor:
+    def forward(self, data: Union[Data, Batch]) -> torch.Tensor:
         """
         :param data: input graph of batch of graphs
         :return: torch.Tensor, output node embeddings
@@ -83,12 +104,24 @@ class Graphormer(nn.Module):
         edge_index = data.edge_index.long()
         edge_attr = data.edge_attr.float()
 
-        if type(data) == Data:
+        # the padded batch layout only depends on the batch, so it is built once for all layers
+        if isinstance(data, Batch):
+            ptr = data.ptr
+            batch_layout = dense_batch_layout(data.batch, ptr)
+        else:
             ptr = None
-            node_paths, edge_paths = shortest_path_distance(data)
+            batch_layout = single_graph_layout(x.shape[0], device=x.device)
+
+        if 'path_edges' in data:
+            # precomputed by PathIndexTransform
+            edge_paths = (data.path_src_index, data.path_dst_index, data.path_edges, data.path_len)
         else:
-            ptr = data.ptr
-            node_paths, edge_paths = batched_shortest_path_distance(data)
+            if ptr is None:
+                node_paths, edge_paths = shortest_path_distance(data)
+            else:
+                node_paths, edge_paths = batched_shortest_path_distance(data)
+            edge_paths = flatten_edge_paths(edge_paths, self.max_path_distance, pad_index=edge_attr.shape[0],
+                                            device=edge_index.device)
 
         x = self.node_in_lin(x)
         edge_attr = self.edge_in_lin(edge_attr)
@@ -96,8 +129,11 @@ class Graphormer(nn.Module):
         x = self.centrality_encoding(x, edge_index)
         b = self.spatial_encoding(x, data.pos)
 
+        # edge_attr is the same for all layers, so a shared edge encoding only has to be computed once
+        c = self.edge_encoding(edge_attr, edge_paths) if self.share_edge_encoding else None
+
         for layer in self.layers:
-            x = layer(x, edge_attr, b, edge_paths, ptr)
+            x = layer(x, edge_attr, b, edge_paths, batch_layout, c)
 
         x = self.node_out_lin(x)
 
@@ -0,0 +1,11 @@
+import importlib.machinery
+import importlib.util
+import sys
+from pathlib import Path
+
+# the modules import each other as CS224W_final_project_testing.*, so register the checkout under that package
+# name even if it was cloned into a directory with a different name
+if 'CS224W_final_project_testing' not in sys.modules:
+    spec = importlib.machinery.ModuleSpec('CS224W_final_project_testing', None, is_package=True)
+    spec.submodule_search_locations = [str(Path(__file__).resolve().parents[1])]
+    sys.modules['CS224W_final_project_testing'] = importlib.util.module_from_spec(spec)
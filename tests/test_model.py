@@ -0,0 +1,162 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torch_geometric')
+
+from torch_geometric.data import Batch, Data
+
+from CS224W_final_project_testing.functional import PathIndexTransform, dense_batch_layout
+from CS224W_final_project_testing.layers import EdgeEncoding, GraphormerEncoderLayer, MASK_GRAD_SDPA_BACKENDS
+from CS224W_final_project_testing.model import Graphormer
+
+MAX_PATH_DISTANCE = 4
+
+DEVICES = ['cpu', pytest.param('cuda', marks=pytest.mark.skipif(not torch.cuda.is_available(),
+                                                              reason='CUDA is not available'))]
+
+
+def ring_graph(num_nodes: int) -> Data:
+    src = torch.arange(num_nodes)
+    dst = (src + 1) % num_nodes
+    edge_index = torch.stack((torch.cat((src, dst)), torch.cat((dst, src))))
+    return Data(x=torch.randn(num_nodes, 4),
+                edge_index=edge_index,
+                edge_attr=torch.randn(edge_index.shape[1], 3),
+                pos=torch.randn(num_nodes, 3))
+
+
+def make_model(compile_layers: bool = False) -> Graphormer:
+    return Graphormer(num_layers=2,
+                      input_node_dim=4,
+                      node_dim=8,
+                      input_edge_dim=3,
+                      edge_dim=4,
+                      output_dim=1,
+                      n_heads=2,
+                      ff_dim=8,
+                      max_in_degree=4,
+                      max_out_degree=4,
+                      max_path_distance=MAX_PATH_DISTANCE,
+                      num_heads_spatial=2,
+                      compile_layers=compile_layers)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+def test_encodings_get_gradients(device):
+    torch.manual_seed(0)
+    transform = PathIndexTransform(max_path_distance=MAX_PATH_DISTANCE)
+    batch = Batch.from_data_list([transform(ring_graph(5)), transform(ring_graph(3))]).to(device)
+    model = make_model().to(device)
+
+    model(batch).sum().backward()
+
+    # spatial and edge encodings only reach the loss through the attention mask of SDPA
+    for param in (model.spatial_encoding.w_left, model.layers[0].attention.edge_encoding.edge_weights):
+        assert param.grad is not None
+        assert param.grad.abs().sum() > 0
+
+
+@pytest.mark.parametrize('device', DEVICES)
+def test_sdpa_mask_gradient_matches_reference(device):
+    from torch.nn.attention import sdpa_kernel
+
+    torch.manual_seed(0)
+    query, key, value = (torch.randn(2, 2, 5, 8, device=device) for _ in range(3))
+    bias = torch.randn(2, 1, 5, 5, device=device, requires_grad=True)
+    reference_bias = bias.detach().clone().requires_grad_()
+
+    with sdpa_kernel(MASK_GRAD_SDPA_BACKENDS):
+        out = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=bias)
+    out.sum().backward()
+
+    scores = query @ key.transpose(-1, -2) / query.shape[-1] ** 0.5 + reference_bias
+    reference = torch.softmax(scores, dim=-1) @ value
+    reference.sum().backward()
+
+    assert torch.allclose(out, reference, atol=1e-5)
+    assert bias.grad is not None
+    assert torch.allclose(bias.grad, reference_bias.grad, atol=1e-5)
+
+
+def test_path_edges_follow_edge_index_columns():
+    torch.manual_seed(0)
+    # path graph 0 - 1 - 2 with edge_index not sorted by source node
+    data = Data(x=torch.randn(3, 4),
+                edge_index=torch.tensor([[1, 0, 2, 1], [2, 1, 1, 0]]),
+                edge_attr=torch.randn(4, 3),
+                pos=torch.randn(3, 3))
+    data = PathIndexTransform(max_path_distance=MAX_PATH_DISTANCE)(data)
+    edge_encoding = EdgeEncoding(edge_dim=3, max_path_distance=MAX_PATH_DISTANCE)
+
+    with torch.no_grad():
+        c = edge_encoding(data.edge_attr, (data.path_src_index, data.path_dst_index, data.path_edges, data.path_len))
+
+    # 0 -> 2 goes through the edges 0 -> 1 (column 1) and 1 -> 2 (column 0)
+    pair = ((data.path_src_index == 0) & (data.path_dst_index == 2)).nonzero().item()
+    weights = edge_encoding.edge_weights.detach()
+    expected = weights[0] @ data.edge_attr[1] + weights[1] @ data.edge_attr[0]
+    assert torch.allclose(c[pair], expected, atol=1e-6)
+
+
+def test_batched_edge_paths_match_path_index_transform():
+    torch.manual_seed(0)
+    transform = PathIndexTransform(max_path_distance=MAX_PATH_DISTANCE)
+    graphs = [ring_graph(5), ring_graph(3), ring_graph(4)]
+    model = make_model().eval()
+
+    with torch.no_grad():
+        precomputed = model(Batch.from_data_list([transform(graph) for graph in graphs]))
+        on_the_fly = model(Batch.from_data_list(graphs))
+
+    assert torch.allclose(precomputed, on_the_fly, atol=1e-5)
+
+
+def test_single_graph_matches_batch_of_one():
+    torch.manual_seed(0)
+    graph = PathIndexTransform(max_path_distance=MAX_PATH_DISTANCE)(ring_graph(5))
+    model = make_model().eval()
+
+    with torch.no_grad():
+        assert torch.allclose(model(graph), model(Batch.from_data_list([graph])), atol=1e-5)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+def test_encoder_layer_traces_without_graph_breaks(device):
+    torch.manual_seed(0)
+    transform = PathIndexTransform(max_path_distance=MAX_PATH_DISTANCE)
+    batch = Batch.from_data_list([transform(ring_graph(5)), transform(ring_graph(3))]).to(device)
+    layer = GraphormerEncoderLayer(node_dim=8, edge_dim=4, n_heads=2, ff_dim=8,
+                                   max_path_distance=MAX_PATH_DISTANCE).to(device)
+
+    num_nodes = batch.num_nodes
+    x = torch.randn(num_nodes, 8, device=device)
+    edge_attr = torch.randn(batch.num_edges, 4, device=device)
+    b = torch.randn(num_nodes, num_nodes, device=device)
+    edge_paths = (batch.path_src_index, batch.path_dst_index, batch.path_edges, batch.path_len)
+    batch_layout = dense_batch_layout(batch.batch, batch.ptr)
+
+    # fullgraph=True raises on any graph break, including in bf16_autocast and sdpa_kernel on CUDA.
+    # The eager backend only checks tracing
+    compiled = torch.compile(layer, fullgraph=True, dynamic=True, backend='eager')
+    assert torch.allclose(compiled(x, edge_attr, b, edge_paths, batch_layout),
+                          layer(x, edge_attr, b, edge_paths, batch_layout), atol=1e-5)
+
+
+@pytest.mark.parametrize('device', DEVICES)
+def test_compiled_layers_match_eager(device):
+    torch.manual_seed(0)
+    transform = PathIndexTransform(max_path_distance=MAX_PATH_DISTANCE)
+    batch = Batch.from_data_list([transform(ring_graph(5)), transform(ring_graph(3))]).to(device)
+    compiled = make_model(compile_layers=True).to(device)
+    eager = make_model().to(device)
+    eager.load_state_dict({key.replace('._orig_mod', ''): value for key, value in compiled.state_dict().items()})
+
+    compiled_out = compiled(batch)
+    eager_out = eager(batch)
+    compiled_out.sum().backward()
+    eager_out.sum().backward()
+
+    # layers run under bf16 autocast on recent GPUs and the compiled kernels round differently
+    atol = 1e-2 if device == 'cuda' else 1e-5
+    assert torch.allclose(compiled_out, eager_out, atol=atol)
+    assert torch.allclose(compiled.spatial_encoding.w_left.grad, eager.spatial_encoding.w_left.grad, atol=atol)